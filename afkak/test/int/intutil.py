@@ -1,4 +1,3 @@
-# -*- coding: utf-8 -*-
 # Copyright 2015 Cyan, Inc.
 # Copyright 2016, 2017, 2018, 2019 Ciena Corporation
 #
@@ -14,12 +13,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import functools
+import binascii
 import logging
 import os
+import random
 import sys
 import time
-import uuid
 from pprint import pformat
 
 from twisted.internet.defer import inlineCallbacks, returnValue
@@ -30,7 +29,7 @@ from afkak.common import (
     SendRequest, TopicAndPartition,
 )
 from afkak.test.int.fixtures import KafkaHarness
-from afkak.test.testutil import async_delay, random_string
+from afkak.test.testutil import async_delay, first, random_string
 
 log = logging.getLogger(__name__)
 
@@ -41,27 +40,55 @@ __all__ = [
 ]
 
 
+_STAT_TEMPLATE = "##teamcity[buildStatisticValue key='%s' value='%s']\n"
+
+
 def stat(key, value):
-    print("##teamcity[buildStatisticValue key='{}' value='{}']".format(
-        key, value), file=sys.stderr)
+    sys.stderr.write(_STAT_TEMPLATE % (key, value))
+
+
+class _LazyStr(object):
+    """
+    Defer building a string until it is formatted, so that log calls which
+    are filtered out don't pay for it.
+
+    :param f: callable which takes no arguments and returns a `str`
+    """
+    __slots__ = ('_f',)
+
+    def __init__(self, f):
+        self._f = f
+
+    def __str__(self):
+        return self._f()
 
 
 def make_send_requests(msgs, topic=None, key=None):
-    return [SendRequest(topic, key, msgs, None)]
+    if not msgs:
+        return ()
+    return (SendRequest(topic, key, msgs, None),)
 
 
 def kafka_versions(*versions):
-    def kafka_versions(func):
-        @functools.wraps(func)
-        def wrapper(self):
-            kafka_version = os.environ.get('KAFKA_VERSION')
+    # KAFKA_VERSION is fixed for the life of the process, so decide whether
+    # to skip when the test is decorated rather than each time it runs.
+    kafka_version = os.environ.get('KAFKA_VERSION')
+    if not kafka_version:
+        skip_reason = "no kafka version specified"
+    elif 'all' not in versions and kafka_version not in versions:
+        skip_reason = "unsupported kafka version"
+    else:
+        skip_reason = None
 
-            if not kafka_version:
-                self.skipTest("no kafka version specified")  # pragma: no cover
-            elif 'all' not in versions and kafka_version not in versions:
-                self.skipTest("unsupported kafka version")  # pragma: no cover
+    def kafka_versions(func):
+        if skip_reason is None:
+            return func
 
-            return func(self)
+        def wrapper(self):
+            self.skipTest(skip_reason)  # pragma: no cover
+        # Trial only needs the name and docstring of the test method.
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
         return wrapper
     return kafka_versions
 
@@ -86,34 +113,54 @@ def ensure_topic_creation(client, topic_name, fully_replicated=True, timeout=5):
 
         If ``False``, only check that any metadata exists for the topic.
 
-    :param timeout: Number of seconds to wait.
+    :param timeout:
+        Number of seconds to wait. This also bounds the wait for the first
+        metadata request.
     '''
     start_time = time.time()
     if fully_replicated:
         check_func = client.topic_fully_replicated
-    else:
-        check_func = client.has_metadata_for_topic
-    yield client.load_metadata_for_topics(topic_name)
 
-    def topic_info():
-        if topic_name in client.topic_partitions:
+        def topic_info():
+            partitions = client.topic_partitions.get(topic_name)
+            if partitions is None:
+                return "No metadata for topic {} found.".format(topic_name)
             return "Topic {} exists. Partition metadata: {}".format(
                 topic_name, pformat([client.partition_meta[TopicAndPartition(topic_name, part)]
-                                     for part in client.topic_partitions[topic_name]]),
+                                     for part in partitions]),
             )
-        else:
+    else:
+        check_func = client.has_metadata_for_topic
+
+        # Only existence matters here, so don't bother formatting the
+        # partition metadata.
+        def topic_info():
+            if topic_name in client.topic_partitions:
+                return "Topic {} exists.".format(topic_name)
             return "No metadata for topic {} found.".format(topic_name)
 
+    yield first([
+        client.load_metadata_for_topics(topic_name),
+        async_delay(timeout, clock=client.reactor),
+    ])
+
+    # Back off exponentially between metadata requests so that a slow broker
+    # isn't hammered with a full metadata request every 10 ms.
+    now = time.time
+    reactor = client.reactor
+    deadline = start_time + timeout
+    delay = 0.01
     while not check_func(topic_name):
-        yield async_delay(clock=client.reactor)
-        if time.time() > start_time + timeout:
+        yield async_delay(delay, clock=reactor)
+        if now() > deadline:
             raise Exception((
                 "Timed out waiting topic {} creation after {} seconds. {}"
             ).format(topic_name, timeout, topic_info()))
-        else:
+        elif delay > 0.1 and log.isEnabledFor(logging.DEBUG):
             log.debug('Still waiting topic creation: %s.', topic_info())
+        delay = min(delay * 2, 0.5)
         yield client.load_metadata_for_topics(topic_name)
-    log.info('%s', topic_info())
+    log.info('%s', _LazyStr(topic_info))
 
 
 class IntegrationMixin(object):
@@ -157,14 +204,17 @@ class IntegrationMixin(object):
 
     @inlineCallbacks
     def setUp(self):
-        log.info("Setting up test %s", self.id())
+        tid = self.id()
+        log.info("Setting up test %s", tid)
+        # A random token per test keeps messages unique across runs while
+        # each message stays a pure function of its seed.
+        self._msg_suffix = (u'-' + tid + u'-').encode('utf-8') + binascii.hexlify(os.urandom(8))
 
         self.harness = KafkaHarness.start(**self.harness_kw)
         self.addCleanup(self.harness.halt)
 
         if not self.topic:
-            self.topic = "%s-%s" % (
-                self.id()[self.id().rindex(".") + 1:], random_string(10))
+            self.topic = "%s-%s" % (tid.rpartition(".")[2], random_string(10))
 
         self.client = KafkaClient(
             self.harness.bootstrap_hosts,
@@ -176,8 +226,6 @@ class IntegrationMixin(object):
         yield ensure_topic_creation(self.client, self.topic,
                                     fully_replicated=True)
 
-        self._messages = {}
-
     def tearDown(self):
         log.info("Tearing down test: %r", self)
 
@@ -193,7 +241,8 @@ class IntegrationMixin(object):
         Call a function, retrying on retriable broker errors.
 
         If calling the function fails with one of these exception types it is
-        called again after a short delay:
+        called again after a delay, which starts at around 100 ms and backs off
+        exponentially (with jitter) to around 2 seconds:
 
         * `afkak.common.RetriableBrokerResponseError` (or a subclass thereof)
         * `afkak.common.PartitionUnavailableError`
@@ -204,15 +253,25 @@ class IntegrationMixin(object):
         :param a: arbitrary positional arguments
         :param kw: arbitrary keyword arguments
         """
+        reactor = self.reactor
+        attempt = 0
         while True:
             try:
                 returnValue((yield f(*a, **kw)))
                 break
             except (RetriableBrokerResponseError, PartitionUnavailableError):
-                yield async_delay(0.1, clock=self.reactor)
+                # Jitter the delay so that tests racing on the same broker
+                # don't retry in lockstep.
+                delay = min(0.1 * (2 ** attempt), 2.0)
+                yield async_delay(delay * (0.5 + random.random() * 0.5), clock=reactor)
+                attempt += 1
 
     def msg(self, s):
-        if s not in self._messages:
-            self._messages[s] = (u'%s-%s-%s' % (s, self.id(), uuid.uuid4())).encode('utf-8')
+        """
+        Get a unique message for *s*. Repeated calls within a test return the
+        same message.
 
-        return self._messages[s]
+        :param str s: message seed
+        :returns: `bytes`
+        """
+        return s.encode('utf-8') + self._msg_suffix
@@ -43,14 +43,24 @@ def first(deferreds):
         add callbacks or cancel it. *first* cancels all other deferreds as soon
         as one fires.
 
-        This sequence must not be mutated by the caller. *first* does not
-        defensively copy.
+        *first* copies the sequence, so the caller may reuse it afterward.
 
     :returns: `Deferred` that fires with the result of the first deferred to
         fire or fail. Canceling this deferred cancels all of the deferreds.
+        When *deferreds* has a single element that deferred itself is
+        returned, which behaves the same way.
     """
+    if len(deferreds) == 1:
+        return deferreds[0]
+
+    # Deferreds which haven't been cancelled yet. This is emptied before any
+    # cancellation so that cancel_all() doesn't cancel deferreds a second time
+    # after one_result() has already done so.
+    remaining = list(deferreds)
+
     def cancel_all(self):
-        for d in deferreds:
+        others, remaining[:] = remaining[:], []
+        for d in others:
             d.cancel()
 
     result_d = Deferred(cancel_all)
@@ -58,8 +68,9 @@ def first(deferreds):
     def one_result(result, source):
         if result_d.called:
             return
+        others, remaining[:] = remaining[:], []
         result_d.callback(result)
-        for d in deferreds:
+        for d in others:
             if d is not source:
                 d.cancel()
 
@@ -89,4 +100,6 @@ def async_delay(timeout=0.01, clock=None):
 
 
 def make_send_requests(msgs, topic=None, key=None):
-    return [SendRequest(topic, key, msgs, None)]
+    if not msgs:
+        return ()
+    return (SendRequest(topic, key, msgs, None),)